@@ -21,8 +21,26 @@ import hashlib
 import base64
 import signal
 import grp
+import selectors
+import ctypes
+import functools
+import glob
+import collections
+import bisect
+import platform
+import errno
 
-logging.basicConfig(filename='kernel.log', level=logging.DEBUG)
+try:
+    from elftools.elf.elffile import ELFFile
+except ImportError:  # pyelftools is optional, nm is used without it
+    ELFFile = None
+
+# Per-message debug records can be turned off with KERNEL_LOG_LEVEL=INFO (or higher),
+# unknown level names keep DEBUG
+log_level = os.environ.get("KERNEL_LOG_LEVEL", "DEBUG").upper()
+if not isinstance(logging.getLevelName(log_level), int):
+    log_level = "DEBUG"
+logging.basicConfig(filename='kernel.log', level=log_level)
 
 def sigterm_handler(sig, frame):
     """SystemExit exception is then caught to guarantee temporary directory removal"""
@@ -32,13 +50,309 @@ def sigterm_handler(sig, frame):
 signal.signal(signal.SIGTERM, sigterm_handler)
 signal.signal(signal.SIGINT, signal.default_int_handler)
 
+libc = ctypes.CDLL(None, use_errno=True)
+IN_CREATE = 0x00000100
+
+# Env messages are at most ENV_MSG_SIZE bytes, recvmmsg takes up to
+# ENV_BATCH_SIZE of them at once
+ENV_MSG_SIZE = 4096
+ENV_BATCH_SIZE = 64
+SOCKADDR_UN_SIZE = 110  # sa_family_t + 108 byte sun_path
+
+# Socket buffers fit many 200 KB embeddings, so bursts do not block senders
+SOCKET_BUF_SIZE = 8 << 20
+
+PROFILE_STRUCT = struct.Struct("ddi")  # runtime_percent runtime_sec size
+EMB_LEN_STRUCT = struct.Struct("i")
+# gmon.out layout (see glibc gmon/sys/gmon_out.h)
+GMON_HDR_SIZE = 20
+GMON_TAG_TIME_HIST = 0
+GMON_TAG_CG_ARC = 1
+GMON_TAG_BB_COUNT = 2
+# gprof addresses histogram in 2 byte units and does not count time of
+# mcount routines and of samples outside symbols (gprof/gprof.c, core.c)
+GPROF_UNIT_SIZE = 2
+GPROF_EXCLUDED_TIME = frozenset(
+    (
+        "_gprof_mcount",
+        "mcount",
+        "_mcount",
+        "__mcount",
+        "__mcount_internal",
+        "__mcleanup",
+        "<locore>",
+        "<hicore>",
+    )
+)
+GPROF_SYMBOL_TYPES = frozenset(("STT_FUNC", "STT_NOTYPE", "STT_OBJECT"))
+SHF_EXECINSTR = 0x4
+
+# "<value> <size> <type> <name>" lines of nm --print-size --radix=d output
+NM_SIZE_RE = re.compile(rb"^\d+[ \t]+(\d+)[ \t]+\S[ \t]+(\S+)", re.MULTILINE)
+# "<%time> <cumulative sec> <self sec> [calls ...] <name>" rows of gprof flat profile
+GPROF_FLAT_RE = re.compile(
+    rb"^[ \t]*([\d.]+)[ \t]+[\d.]+[ \t]+([\d.]+)[ \t].*?(\S+)[ \t]*$", re.MULTILINE
+)
+
+
+def renice_to_zero(pid=0):
+    """Resets niceness of process pid (calling process by default) to 0"""
+    os.setpriority(os.PRIO_PROCESS, pid, 0)
+
+
+def sudo_renice_to_zero():
+    """Same as renice_to_zero(), but through sudo for processes without CAP_SYS_NICE"""
+    os.spawnvp(os.P_WAIT, "sudo", ["sudo", "renice", "-n", "0", str(os.getpid())])
+
+
+@functools.lru_cache(maxsize=4096)
+def hash_fun_name(fun_name, avail_length):
+    """
+    If needed, hashes symbol name and encodes it in base64 to fit into
+    avail_length characters of socket address (results are memoized)
+    """
+    fun_name = fun_name.partition(".")[0]
+    if len(fun_name) > avail_length or len(fun_name) > 100:
+        # Envs derive their socket names the same way, so hash can not be changed
+        return base64.urlsafe_b64encode(
+            hashlib.sha256(fun_name.encode("utf-8"), usedforsecurity=False).digest()
+        ).decode("utf-8")
+    else:
+        return fun_name
+
+
+def read_gmon_histograms(path, byteorder, ptr_size):
+    """
+    Decodes time histogram records of gmon.out file written by glibc
+
+    byteorder ("<" or ">") and ptr_size are those of profiled binary
+    Returns list of (low_pc, high_pc, prof_rate, bins) tuples
+    """
+    data = Path(path).read_bytes()
+    if data[:4] != b"gmon":
+        raise ValueError(f"{path} is not a gmon.out file")
+    ptr = "Q" if ptr_size == 8 else "I"
+    hist_hdr = struct.Struct(f"{byteorder}{ptr}{ptr}ii16x")
+    arc_size = 2 * ptr_size + 4
+    histograms = []
+    offset = GMON_HDR_SIZE
+    while offset < len(data):
+        tag = data[offset]
+        offset += 1
+        if tag == GMON_TAG_TIME_HIST:
+            low_pc, high_pc, hist_size, prof_rate = hist_hdr.unpack_from(data, offset)
+            offset += hist_hdr.size
+            bins = struct.unpack_from(f"{byteorder}{hist_size}H", data, offset)
+            offset += 2 * hist_size
+            histograms.append((low_pc, high_pc, prof_rate, bins))
+        elif tag == GMON_TAG_CG_ARC:
+            offset += arc_size
+        elif tag == GMON_TAG_BB_COUNT:
+            (ncounts,) = struct.unpack_from(f"{byteorder}i", data, offset)
+            offset += 4 + ncounts * 2 * ptr_size
+        else:
+            raise ValueError(f"{path}: unknown gmon record tag {tag}")
+    return histograms
+
+
+def gmon_sampled_seconds(path, byteorder, ptr_size):
+    """
+    Returns runtime accumulated in time histograms of gmon.out file
+    """
+    return sum(
+        sum(bins) / prof_rate
+        for _, _, prof_rate, bins in read_gmon_histograms(path, byteorder, ptr_size)
+        if prof_rate > 0
+    )
+
+
+def read_gprof_symbols(elf):
+    """
+    Selects symbols of profiled binary the way gprof flat profile does
+
+    Text symbols (nm classes T, t) and weak symbols (W) are kept, static ones
+    only when their names have no '.' or '$', so local clones like
+    foo.constprop.0 or foo.part.0 are dropped and their samples fall to the
+    preceding symbol. At shared address global symbol is preferred, then name
+    without leading underscore. Returns sorted (address, name) list and end
+    address of the kept symbols
+    """
+    symbols = {}  # address -> (is_static, name)
+    end = 0
+    symtab = elf.get_section_by_name(".symtab")
+    for symbol in symtab.iter_symbols() if symtab != None else []:
+        bind = symbol["st_info"]["bind"]
+        shndx = symbol["st_shndx"]
+        name = symbol.name
+        if not name or symbol["st_info"]["type"] not in GPROF_SYMBOL_TYPES:
+            continue
+        if not isinstance(shndx, int):  # undefined, absolute or common
+            continue
+        if bind == "STB_WEAK":
+            if symbol["st_info"]["type"] == "STT_OBJECT":
+                continue
+        elif not elf.get_section(shndx)["sh_flags"] & SHF_EXECINSTR:
+            continue
+        elif bind == "STB_LOCAL":
+            if "." in name or "$" in name or name.startswith("__gnu_compiled"):
+                continue
+        elif bind != "STB_GLOBAL":
+            continue
+        is_static = bind == "STB_LOCAL"
+        address = symbol["st_value"]
+        if address in symbols:
+            other_static, other = symbols[address]
+            if not (
+                (other_static and not is_static)
+                or (
+                    other_static == is_static
+                    and other[0] == "_"
+                    and (name[0] != "_" or (other[1:2] == "_" and name[1:2] != "_"))
+                )
+            ):
+                continue
+        symbols[address] = (is_static, name)
+        end = max(end, address + max(symbol["st_size"], 1))
+    return [(address, symbols[address][1]) for address in sorted(symbols)], end
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class ProfileRecord:
+    """
+    Profile data collected for one symbol during compilation cycle
+    """
+
+    __slots__ = ("size", "rt_pct", "rt_sec", "embedding")
+
+    def __init__(self):
+        self.reset()
+
+    def copy(self):
+        """Returns independent copy of the record"""
+        record = ProfileRecord()
+        record.size = self.size
+        record.rt_pct = self.rt_pct
+        record.rt_sec = self.rt_sec
+        record.embedding = self.embedding
+        return record
+
+    def reset(self):
+        """Drops data of previous compilation cycle"""
+        self.size = None
+        self.rt_pct = 0.0
+        self.rt_sec = 0.0
+        self.embedding = None
+
+
+class GccCompilation:
+    """
+    gcc process driven through phase reorder plugin, together with
+    kernel socket its plugin talks to
+    """
+
+    __slots__ = (
+        "instance",
+        "pidfd",
+        "socket",
+        "plugin_name",
+        "plugin_addr",
+        "record_embeddings",
+    )
+
+    def __init__(self, build_str, kernel_socket, plugin_name, record_embeddings):
+        self.instance = Popen(build_str, shell=True)
+        self.pidfd = os.pidfd_open(self.instance.pid)
+        self.socket = kernel_socket
+        self.plugin_name = plugin_name
+        self.plugin_addr = plugin_name.encode()
+        self.record_embeddings = record_embeddings
+
+    def stop(self):
+        """Kills gcc if it is still running, reaps it and closes its pidfd"""
+        if self.instance.poll() == None:
+            self.instance.kill()
+        self.instance.wait()
+        if self.pidfd != None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+class EnvMessageBatch:
+    """
+    Preallocated recvmmsg buffers for draining queued env messages
+    with one system call
+    """
+
+    def __init__(self):
+        self.data = (ctypes.c_char * ENV_MSG_SIZE * ENV_BATCH_SIZE)()
+        self.names = (ctypes.c_char * SOCKADDR_UN_SIZE * ENV_BATCH_SIZE)()
+        self.iovecs = (IOVec * ENV_BATCH_SIZE)()
+        self.headers = (MMsgHdr * ENV_BATCH_SIZE)()
+        for i in range(ENV_BATCH_SIZE):
+            self.iovecs[i].iov_base = ctypes.addressof(self.data[i])
+            self.iovecs[i].iov_len = ENV_MSG_SIZE
+            self.headers[i].msg_hdr.msg_name = ctypes.addressof(self.names[i])
+            self.headers[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.headers[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self, sock):
+        """
+        Returns (data, address) pairs of all messages queued on sock, without blocking
+
+        Addresses are returned the way socket.recvfrom returns them
+        (bytes for abstract names, str for pathnames, None for unbound senders)
+        """
+        messages = []
+        while True:
+            for i in range(ENV_BATCH_SIZE):
+                self.headers[i].msg_hdr.msg_namelen = SOCKADDR_UN_SIZE
+            count = libc.recvmmsg(
+                sock.fileno(), self.headers, ENV_BATCH_SIZE, socket.MSG_DONTWAIT, None
+            )
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return messages
+                raise OSError(err, f"recvmmsg failed: {os.strerror(err)}")
+            for i in range(count):
+                header = self.headers[i]
+                if header.msg_hdr.msg_namelen == 0:  # unbound sender
+                    addr = None
+                else:
+                    addr = self.names[i].raw[2 : header.msg_hdr.msg_namelen]
+                    if not addr.startswith(b"\0"):
+                        addr = os.fsdecode(addr.partition(b"\0")[0])
+                messages.append((self.data[i].raw[: header.msg_len], addr))
+            if count < ENV_BATCH_SIZE:
+                return messages
+
+
 class MultienvBenchKernel:
-    def __init__(self, env_socket, gcc_socket):
+    def __init__(self, env_socket, gcc_socket, gprof_socket):
         """
         Parses command-line arguments and initializes kernel instance
 
         Function arguments:
-            env_socket, gcc_socket -- UNIX datagram socket instances (not bound)
+            env_socket, gcc_socket, gprof_socket -- UNIX datagram socket instances (not bound)
 
         Command line arguments:
         -r, --run
@@ -54,11 +368,27 @@ class MultienvBenchKernel:
             Instance number of benchmark, impacts socket names (<name>:backend_<instance>)
 
         --repeats
-            Number of times that benchmark is run to profile for runtimes
+            Maximum number of times that benchmark is run to profile for runtimes
+
+        --runtime-target-sec
+            Profiling stops repeating benchmark once this many seconds of
+            samples are accumulated (0 always runs all repeats)
 
         -p, --plugin
             Path to phase reorder plugin .so
 
+        --profile-jobs
+            Number of benchmark runs executed concurrently when profiling
+            for runtimes (defaults to number of CPUs)
+
+        --profile-cache
+            Number of recent pass list sets whose profiles are kept, so that
+            repeated sets are answered without recompilation (0 disables cache)
+
+        --static-profile
+            Link instrumented benchmark statically, so that each qemu run
+            skips dynamic loader emulation
+
         Kernel expects all files required for benchmark build and run to already be placed into working dir
         It also parses benchmark_info.txt file to get all possible symbol names
         (used when checking for alive, but afk environments)
@@ -96,54 +426,151 @@ class MultienvBenchKernel:
         self.parser.add_argument(
             "-p", "--plugin", dest="plugin_path", action="store", default="plugin"
         )
+        self.parser.add_argument(
+            "--profile-jobs",
+            type=int,
+            dest="profile_jobs",
+            action="store",
+            default=os.cpu_count(),
+        )
+        self.parser.add_argument(
+            "--profile-cache",
+            type=int,
+            dest="profile_cache_size",
+            action="store",
+            default=16,
+        )
+        self.parser.add_argument(
+            "--static-profile", dest="static_profile", action="store_true"
+        )
+        self.parser.add_argument(
+            "--runtime-target-sec",
+            type=float,
+            dest="runtime_target_sec",
+            action="store",
+            default=1.0,
+        )
         self.args = self.parser.parse_args()
+        if self.args.profile_jobs < 1:
+            self.parser.error("--profile-jobs must be at least 1")
 
         if self.args.run_string == []:
             self.args.run_string = [""]
 
+        # Room left for symbol name in "\0<name>:<symbol>_<instance>" address
+        self.avail_length = (
+            107 - len(self.args.bench_name) - len(str(self.args.instance)) - 2
+        )
+
         self.pid = os.getpid()
         self.socket_name = f"kernel{self.pid}.soc"
         self.gcc_name = f"gcc_plugin{self.pid}.soc"
+        # Instrumented build runs alongside main one, so its plugin gets own sockets
+        self.gprof_socket_name = f"kernel{self.pid}_pg.soc"
+        self.gprof_gcc_name = f"gcc_plugin{self.pid}_pg.soc"
 
-        self.build_str = (
-            f"$AARCH_GCC -fplugin={self.args.plugin_path} -O2 -fplugin-arg-plugin-dyn_replace=learning "
-            f"-fplugin-arg-plugin-remote_socket={self.socket_name} -fplugin-arg-plugin-socket_postfix={self.pid} "
-            f"{self.args.build_string} -o main.elf"
-        )
+        # Binutils are run directly; build and run strings are user supplied shell
+        # fragments (globs, redirections), so they keep going through sh, which
+        # execs into gcc/qemu instead of forking it
+        self.tool_prefix = os.environ.get("AARCH_PREFIX", "")
+        # Instrumented benchmark is run natively on aarch64 hosts, qemu is only
+        # needed for emulation elsewhere
+        if platform.machine() == "aarch64":
+            self.bench_runner = "./pg_main.elf"
+        else:
+            self.bench_runner = "qemu-aarch64 -L /usr/aarch64-linux-gnu ./pg_main.elf"
 
-        self.gprof_build_str = (
-            f"$AARCH_GCC -fplugin={self.args.plugin_path} -O2 -fplugin-arg-plugin-dyn_replace=learning "
-            f"-fplugin-arg-plugin-remote_socket={self.socket_name} -fplugin-arg-plugin-socket_postfix={self.pid} -pg "
-            f"{self.args.build_string} -o pg_main.elf"
+        self.build_str = self.gcc_build_str(self.socket_name, self.pid, "", "main.elf")
+        self.gprof_build_str = self.gcc_build_str(
+            self.gprof_socket_name,
+            f"{self.pid}_pg",
+            f"-pg {'-static ' if self.args.static_profile else ''}",
+            "pg_main.elf",
         )
 
         self.EMBED_LEN_MULTIPLIER = 200
 
+        # "No list" reply and scratch buffer every embedding is received into
+        # are reused for every gcc request
+        self.empty_list_msg = bytes(1)
+        self.embedding_buf = bytearray(1024 * self.EMBED_LEN_MULTIPLIER)
+        self.embedding_view = memoryview(self.embedding_buf)
+        # Headers of env profile messages are packed in place for every symbol
+        self.emb_len_buf = bytearray(EMB_LEN_STRUCT.size)
+        self.profile_buf = bytearray(PROFILE_STRUCT.size)
+
         groups = os.getgroups()
         self.can_renice = False
         for group in groups:
             if grp.getgrgid(group)[0] == 'nice':
                 self.can_renice = True
 
+        # Probe once if niceness can be reset directly, so bench runs
+        # do not go through sudo on every repeat. Directly reniced runs are reset
+        # from kernel right after start, as any preexec_fn makes subprocess
+        # use fork instead of vfork
+        self.renice_bench_runs = False
+        self.qemu_preexec = None
+        if os.getpriority(os.PRIO_PROCESS, 0) != 0:
+            try:
+                run(["true"], preexec_fn=renice_to_zero, check=True)
+                self.renice_bench_runs = True
+            except (SubprocessError, OSError):
+                self.qemu_preexec = sudo_renice_to_zero if self.can_renice else None
+
         symbols_list = Path("benchmark_info.txt")
         lines = [x.strip() for x in symbols_list.read_text().splitlines()]
         index = lines.index("functions:") + 1
-        self.bench_symbols = [self.encode_fun_name(x) for x in lines[index:]]
+        # Blank lines are skipped and names sharing encoding are kept once
+        self.bench_symbols = list(
+            dict.fromkeys(self.encode_fun_name(x) for x in lines[index:] if x)
+        )
+        self.env_addr_prefix = f"\0{self.args.bench_name}:".encode("utf-8")
+        self.env_addr_suffix = f"_{self.args.instance}".encode("utf-8")
+        self.env_addresses = {
+            fun_name: self.env_addr_prefix + fun_name.encode("utf-8") + self.env_addr_suffix
+            for fun_name in self.bench_symbols
+        }
+        # Records are allocated once and reset in place every compilation cycle
+        self.profiles = {fun_name: ProfileRecord() for fun_name in self.bench_symbols}
+        # Pass list set -> profiles of its symbols, in least recently used order
+        self.profile_cache = collections.OrderedDict()
 
         try:
             long_fun_index = lines.index("long_functions:")
-            self.long_functions = [
-                self.encode_fun_name(x) for x in lines[long_fun_index:index]
-            ]
+            self.long_functions = frozenset(
+                self.encode_fun_name(x)
+                for x in lines[long_fun_index + 1 : index - 1]
+                if x
+            )
         except ValueError:
-            self.long_functions = self.bench_symbols
+            self.long_functions = frozenset(self.bench_symbols)
 
         self.env_socket = env_socket
         self.gcc_socket = gcc_socket
+        self.gprof_socket = gprof_socket
+
+        self.gcc_compilations = []
+        # Raw names sent by plugin -> encoded symbol names, so names gcc sends
+        # again in later cycles are not decoded and hashed again
+        self.plugin_fun_names = {}
+        self.env_batch = EnvMessageBatch()
+        self.symtab_digest = None
+
+        # Watch working directory for gcc plugin socket creation
+        self.inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.inotify_fd < 0 or libc.inotify_add_watch(
+            self.inotify_fd, b".", IN_CREATE
+        ) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify setup failed: {os.strerror(err)}")
 
-        self.gcc_instance = None
+        for sock in (self.env_socket, self.gcc_socket, self.gprof_socket):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUF_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUF_SIZE)
 
         self.gcc_socket.bind(self.socket_name)
+        self.gprof_socket.bind(self.gprof_socket_name)
         self.env_socket.bind(f"\0{self.args.bench_name}:backend_{self.args.instance}")
         logging.debug("KERNEL: init end")
 
@@ -154,16 +581,29 @@ class MultienvBenchKernel:
         """
         if isinstance(e, SystemExit) and e.code == 1:
             print(self.active_funcs_lists, file=sys.stderr, flush=True)
-        if self.gcc_instance != None:
+        for compilation in self.gcc_compilations:
             try:
-                self.gcc_instance.wait(30)
+                compilation.instance.wait(30)
             except TimeoutExpired:
                 pass
+            # gcc whose plugin still waits for kernel reply would never exit
+            compilation.stop()
         cwd = os.path.abspath(os.getcwd())
         if cwd.startswith("/tmp") or cwd.startswith("/run"):
-            shutil.rmtree(os.getcwd())
+            # Removed by detached rm, so kernel exit does not wait for the tree walk
+            try:
+                Popen(
+                    ["rm", "-rf", cwd],
+                    start_new_session=True,
+                    stdin=DEVNULL,
+                    stdout=DEVNULL,
+                    stderr=DEVNULL,
+                )
+            except OSError:
+                shutil.rmtree(cwd)
         else:
             os.unlink(self.socket_name)
+            os.unlink(self.gprof_socket_name)
 
     def sendout_profiles(self):
         """
@@ -171,209 +611,373 @@ class MultienvBenchKernel:
         lists before compilation start
         """
         for fun_name in self.active_funcs_lists:
-            func_env_address = (
-                f"\0{self.args.bench_name}:{fun_name}_{self.args.instance}"
-            )
-            if fun_name not in self.sizes:
+            func_env_address = self.env_addresses[fun_name]
+            profile = self.profiles[fun_name]
+            if profile.size == None:
                 print(
                     f"Symbol [{fun_name}] was not properly profiled, size or runtime data missing",
                     file=sys.stderr,
                 )
-                self.sizes[fun_name] = 0
+                profile.size = 0
             try:
-                profile_data = bytes(
-                    struct.pack(  # runtime_percent runtime_sec size
-                        "ddi",
-                        self.runtimes.get(fun_name, (0.0, 0.0))[0],
-                        self.runtimes.get(fun_name, (0.0, 0.0))[1],
-                        self.sizes[fun_name],
-                    )
+                EMB_LEN_STRUCT.pack_into(self.emb_len_buf, 0, len(profile.embedding))
+                PROFILE_STRUCT.pack_into(
+                    self.profile_buf, 0, profile.rt_pct, profile.rt_sec, profile.size
                 )
-                message = self.embeddings[fun_name] + profile_data
-                self.env_socket.sendto(
-                    message,
+                # Gather-write length, embedding and profile data without concatenation
+                self.env_socket.sendmsg(
+                    [self.emb_len_buf, profile.embedding, self.profile_buf],
+                    [],
+                    0,
                     func_env_address,
                 )
             except (ConnectionError, FileNotFoundError):
                 print(
-                    f"Environment [{func_env_address}] unexpectedly died",
+                    f"Environment [{func_env_address.decode('utf-8')}] unexpectedly died",
                     file=sys.stderr,
                 )
 
     def get_sizes(self):
         """
-        Parses nm output to get symbol sizes
+        Reads symbol sizes from main.elf symbol table in-process with pyelftools,
+        or parses nm output if pyelftools is not installed
+        """
+        if ELFFile == None:
+            self.get_sizes_nm()
+            return
+        with open("main.elf", "rb") as elf_file:
+            symtab = ELFFile(elf_file).get_section_by_name(".symtab")
+            if symtab == None:
+                return
+            for symbol in symtab.iter_symbols():
+                size = symbol["st_size"]
+                if size == 0 or symbol["st_shndx"] == "SHN_UNDEF":
+                    continue
+                profile = self.profiles.get(self.encode_fun_name(symbol.name))
+                # Largest of symbols sharing encoded name wins, as with nm --size-sort
+                if profile != None and (profile.size == None or size > profile.size):
+                    profile.size = size
+
+    def get_sizes_nm(self):
+        """
+        Parses nm output to get symbol sizes, line by line as nm writes it
         """
-        size_info = (
+        with Popen(
+            [self.tool_prefix + "nm", "--print-size", "--size-sort", "--radix=d", "main.elf"],
+            stdout=PIPE,
+        ) as nm:
+            for line in nm.stdout:
+                match = NM_SIZE_RE.match(line)
+                if match == None:
+                    continue
+                profile = self.profiles.get(self.encode_fun_name(match[2].decode("utf-8")))
+                if profile != None:
+                    profile.size = int(match[1])
+
+    def build_symtab(self):
+        """
+        Writes gprof symbol table for pg_main.elf, unless it was already
+        built for identical binary (symbol addresses depend on generated code,
+        so table is tied to binary contents rather than to symbol names)
+        """
+        digest = hashlib.blake2b(Path("pg_main.elf").read_bytes()).digest()
+        if digest == self.symtab_digest:
+            return
+        with open("symtab", "wb") as symtab:
             run(
-                "${AARCH_PREFIX}nm --print-size --size-sort --radix=d main.elf",
-                shell=True,
-                capture_output=True,
+                [
+                    self.tool_prefix + "nm",
+                    "--extern-only",
+                    "--defined-only",
+                    "-v",
+                    "--print-file-name",
+                    "pg_main.elf",
+                ],
+                stdout=symtab,
+                stderr=DEVNULL,
             )
-            .stdout.decode("utf-8")
-            .splitlines()
-        )
-        self.sizes = {}
-        for line in size_info:
-            pieces = line.split()
-            self.sizes[self.encode_fun_name(pieces[3])] = int(pieces[1])
+        self.symtab_digest = digest
 
     def get_runtimes(self):
         """
         Runs instrumented benchmarks, sums their runtime data using gprof
         and parses its output for runtime information
+
+        Number of runs grows in doubling batches (first one filling --profile-jobs)
+        up to --repeats until --runtime-target-sec of samples are accumulated
         """
-        run(
-            "${AARCH_PREFIX}nm --extern-only --defined-only -v --print-file-name pg_main.elf > symtab",
-            shell=True,
-            capture_output=True,
-        )
-        sum_exists = False
-        if self.can_renice:
-            def qemu_renice():
-                pid = os.getpid()
-                os.system(f'sudo renice -n 0 {pid}')
+        # Every run writes its own gmon.out.<pid>, so runs are independent
+        # and can be executed concurrently and summed by gprof in one go
+        bench_env = dict(os.environ, GMON_OUT_PREFIX="gmon.out")
+        bench_cmds = [
+            f"exec {self.bench_runner} {run_str}"
+            for run_str in self.args.run_string
+        ]
+        target_sec = self.args.runtime_target_sec
+        if target_sec <= 0:
+            self.run_benchmarks(bench_cmds, bench_env, self.args.bench_repeats)
         else:
-            def qemu_renice():
-                pass
-        for i in range(0, self.args.bench_repeats):
-            for run_str in self.args.run_string:
-                run(
-                    f"qemu-aarch64 -L /usr/aarch64-linux-gnu ./pg_main.elf {run_str}",
-                    shell=True,
-                    stdout=DEVNULL,
-                    stderr=DEVNULL,
-                    preexec_fn=qemu_renice
+            # First batch fills all profile jobs, as it costs no extra wall time;
+            # batches are then doubled until enough samples are accumulated
+            with open("pg_main.elf", "rb") as elf_file:
+                ident = elf_file.read(6)
+            byteorder = "<" if ident[5] == 1 else ">"  # EI_DATA
+            ptr_size = 8 if ident[4] == 2 else 4  # EI_CLASS
+            sampled_sec = 0.0
+            counted_files = set()
+            done_repeats = 0
+            batch = max(1, self.args.profile_jobs // len(bench_cmds))
+            while done_repeats < self.args.bench_repeats and sampled_sec < target_sec:
+                batch = min(batch, self.args.bench_repeats - done_repeats)
+                self.run_benchmarks(bench_cmds, bench_env, batch)
+                done_repeats += batch
+                batch *= 2
+                if done_repeats == self.args.bench_repeats:
+                    break
+                for gmon_file in glob.glob("gmon.out.*"):
+                    if gmon_file not in counted_files:
+                        counted_files.add(gmon_file)
+                        sampled_sec += gmon_sampled_seconds(gmon_file, byteorder, ptr_size)
+                logging.debug(
+                    "KERNEL: sampled %.2f sec in %d repeats", sampled_sec, done_repeats
                 )
-                run(
-                    f"${{AARCH_PREFIX}}gprof -s -Ssymtab pg_main.elf gmon.out{' gmon.sum' if sum_exists else ''}",
-                    shell=True,
-                    check=True,
-                )
-                sum_exists = True
 
-        runtime_data = (
-            run(
-                "${AARCH_PREFIX}gprof -bp --no-demangle pg_main.elf gmon.sum",
-                shell=True,
-                capture_output=True,
-                check=True,
-            )
-            .stdout.decode("utf-8")
-            .splitlines()
+        gmon_files = glob.glob("gmon.out.*")
+        if ELFFile == None:
+            self.read_runtimes_gprof(gmon_files)
+        else:
+            self.read_runtimes_gmon(gmon_files)
+        for gmon_file in gmon_files:
+            os.unlink(gmon_file)
+
+    def run_benchmarks(self, bench_cmds, bench_env, repeats):
+        """
+        Runs every benchmark command repeats times, at most profile_jobs
+        runs at once, and waits for all of them to finish
+        """
+        running = []
+        try:
+            for i in range(0, repeats):
+                for bench_cmd in bench_cmds:
+                    if len(running) >= self.args.profile_jobs:
+                        running[0].wait()
+                        running.pop(0)
+                    running.append(
+                        Popen(
+                            bench_cmd,
+                            shell=True,
+                            stdout=DEVNULL,
+                            stderr=DEVNULL,
+                            env=bench_env,
+                            preexec_fn=self.qemu_preexec,
+                        )
+                    )
+                    if self.renice_bench_runs:
+                        renice_to_zero(running[-1].pid)
+            for bench_run in running:
+                bench_run.wait()
+        except BaseException:
+            # As with subprocess.run(), runs are not left behind on errors or
+            # signals, so they do not write gmon files into removed directory
+            for bench_run in running:
+                bench_run.kill()
+                bench_run.wait()
+            raise
+
+    def read_runtimes_gprof(self, gmon_files):
+        """
+        Sums gmon files with gprof and parses its flat profile for runtime information
+        """
+        self.build_symtab()
+        run(
+            [self.tool_prefix + "gprof", "-s", "-Ssymtab", "pg_main.elf", *gmon_files],
+            check=True,
         )
-        os.unlink("gmon.out")
+
+        runtime_data = run(
+            [self.tool_prefix + "gprof", "-bp", "--no-demangle", "pg_main.elf", "gmon.sum"],
+            capture_output=True,
+            check=True,
+        ).stdout
         os.unlink("gmon.sum")
 
-        self.runtimes = {}
-        if " no time accumulated" in runtime_data:
-            for fun_name in self.active_funcs_lists.keys():
-                self.runtimes[self.encode_fun_name(fun_name)] = (0.0, 0.0)
-        else:
-            runtime_data = runtime_data[5:]
-            for line in runtime_data:
-                pieces = line.split()
-                self.runtimes[self.encode_fun_name(pieces[-1])] = (
-                    float(pieces[0]),
-                    float(pieces[2]),
-                )
+        # With no time accumulated all runtimes are left at their 0.0 defaults
+        if b"\n no time accumulated\n" not in runtime_data:
+            for match in GPROF_FLAT_RE.finditer(runtime_data):
+                profile = self.profiles.get(self.encode_fun_name(match[3].decode("utf-8")))
+                if profile != None:
+                    profile.rt_pct = float(match[1])
+                    profile.rt_sec = float(match[2])
 
-    def compile_instrumented(self):
+    def read_runtimes_gmon(self, gmon_files):
         """
-        Compiles benchmarks using received lists and with enabled -pg flag
-        (for per-function runtime profiling)
+        Decodes gmon file histograms in-process and attributes samples to
+        pg_main.elf symbols with gprof flat profile arithmetic, so no gprof
+        subprocesses are needed
         """
-        self.gcc_instance = Popen(
-            self.gprof_build_str, shell=True
-        )  # Compile with gprof to get per-function runtime info
-
-        while not os.path.exists(self.gcc_name):
-            self.gcc_instance.poll()
-            if self.gcc_instance.returncode != None:
-                print(
-                    f"gcc failed on startup: return code {self.gcc_instance.returncode}\n",
-                    file=sys.stderr,
-                )
-                exit(1)
-            pass
+        with open("pg_main.elf", "rb") as elf_file:
+            elf = ELFFile(elf_file)
+            byteorder = "<" if elf.little_endian else ">"
+            ptr_size = elf.elfclass // 8
+            symbols, symbols_end = read_gprof_symbols(elf)
 
-        while self.gcc_instance.poll() == None:
-            try:
-                fun_name = self.gcc_socket.recv(4096, socket.MSG_DONTWAIT).decode(
-                    "utf-8"
-                )
-                sock_fun_name = self.encode_fun_name(fun_name)
-                if sock_fun_name in self.active_funcs_lists:
-                    self.gcc_socket.sendto(
-                        self.active_funcs_lists[sock_fun_name],
-                        self.gcc_name.encode(),
-                    )
-                    embedding = self.gcc_socket.recv(1024 * self.EMBED_LEN_MULTIPLIER)
+        histograms = {}
+        for gmon_file in gmon_files:
+            for low_pc, high_pc, prof_rate, bins in read_gmon_histograms(
+                gmon_file, byteorder, ptr_size
+            ):
+                key = (low_pc, high_pc, prof_rate, len(bins))
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], bins)]
                 else:
-                    list_msg = bytes(1)
-                    self.gcc_socket.sendto(list_msg, self.gcc_name.encode())
-                    embedding = self.gcc_socket.recv(1024 * self.EMBED_LEN_MULTIPLIER)
-            except BlockingIOError:
-                pass
+                    histograms[key] = list(bins)
 
-        if self.gcc_instance.wait() != 0:
-            print(
-                f"gcc failed: return code {self.gcc_instance.returncode}\n",
-                file=sys.stderr,
-            )
-            exit(1)
+        # As in gprof, symbol spans up to the next symbol start, samples before
+        # the first and after the last symbol go to <locore> and <hicore>, and
+        # bins overlapping several symbols are split by truncated unit bounds
+        starts = [0] + [address // GPROF_UNIT_SIZE for address, _ in symbols]
+        starts.append(symbols_end // GPROF_UNIT_SIZE + 1)
+        names = ["<locore>"] + [name for _, name in symbols] + ["<hicore>"]
+        ends = starts[1:] + [float("inf")]
+        total_time = 0.0
+        fun_times = {}
+        for (low_pc, high_pc, prof_rate, num_bins), bins in histograms.items():
+            low_unit = low_pc // GPROF_UNIT_SIZE
+            scale = (high_pc // GPROF_UNIT_SIZE - low_unit) / num_bins
+            for i, count in enumerate(bins):
+                if count == 0:
+                    continue
+                time = count / prof_rate
+                total_time += time
+                bin_low = low_unit + int(scale * i)
+                bin_high = low_unit + int(scale * (i + 1))
+                j = max(bisect.bisect_right(starts, bin_low) - 1, 0)
+                while j < len(starts) and starts[j] < bin_high:
+                    overlap = min(bin_high, ends[j]) - max(bin_low, starts[j])
+                    if overlap > 0:
+                        credit = overlap * time / scale
+                        if names[j] in GPROF_EXCLUDED_TIME:
+                            total_time -= credit
+                        else:
+                            fun_times[names[j]] = fun_times.get(names[j], 0.0) + credit
+                    j += 1
+
+        # With no time accumulated all runtimes are left at their 0.0 defaults
+        if total_time <= 0:
+            return
+        # Applied in flat profile order and rounded as gprof prints them, so
+        # symbols sharing encoded name resolve the same way as with gprof
+        for name, time in sorted(fun_times.items(), key=lambda item: (-item[1], item[0])):
+            profile = self.profiles.get(self.encode_fun_name(name))
+            if profile != None:
+                profile.rt_pct = round(100 * time / total_time, 2)
+                profile.rt_sec = round(time, 2)
+
+    def wait_gcc_startup(self, compilation):
+        """
+        Sleeps until gcc plugin creates its socket or gcc exits
+
+        Wakes up on inotify events for working directory and on gcc pidfd
+        becoming readable, so gcc startup is not raced by a busy loop
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.inotify_fd, selectors.EVENT_READ)
+            selector.register(compilation.pidfd, selectors.EVENT_READ)
+
+            while not os.path.exists(compilation.plugin_name):
+                for key, _ in selector.select():
+                    if key.fd == compilation.pidfd:  # gcc exited, reap it without polling
+                        print(
+                            f"gcc failed on startup: return code {compilation.instance.wait()}\n",
+                            file=sys.stderr,
+                        )
+                        self.stop_compilations()
+                        exit(1)
+                try:
+                    while os.read(self.inotify_fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
 
     def encode_fun_name(self, fun_name):
         """
         If needed, hashes symbol name and encodes it in base64 to fit into
         108 characters socket addr length limitation
         """
-        fun_name = fun_name.partition(".")[0]
-        avail_length = (
-            107 - len(self.args.bench_name) - len(str(self.args.instance)) - 2
-        )
-        if len(fun_name) > avail_length or len(fun_name) > 100:
-            return base64.b64encode(
-                hashlib.sha256(fun_name.encode("utf-8")).digest(),
-                "-_".encode("utf-8"),
-            ).decode("utf-8")
-        else:
-            return fun_name
+        return hash_fun_name(fun_name, self.avail_length)
 
-    def validate_addr(self, parsed_addr):
+    def validate_addr(self, addr):
         """
         Checks if addres matches kernel benchmark name, instance number and symbol list
+        and returns symbol name from it
+
+        Address is "\0<name>:<symbol>_<instance>", so name and instance are checked
+        as fixed bytes prefix and suffix instead of parsing whole address
         """
-        if parsed_addr[1] != self.args.bench_name:
+        if not addr.startswith(self.env_addr_prefix):
             print(
                 f"Got message from env with incorrect bench name. "
-                f"Expected '{self.args.bench_name}' got '{parsed_addr[1]}'",
+                f"Expected '{self.args.bench_name}' got '{addr[1:].partition(b':')[0].decode('utf-8')}'",
                 file=sys.stderr,
             )
             exit(1)
-        if int(parsed_addr[3]) != self.args.instance:
+        if not addr.endswith(self.env_addr_suffix):
             print(
                 f"Got message from env with incorrect instance number. "
-                f"Expected '{self.args.instance}' got '{parsed_addr[3]}'",
+                f"Expected '{self.args.instance}' got '{addr.rpartition(b'_')[2].decode('utf-8')}'",
                 file=sys.stderr,
             )
             exit(1)
-        if parsed_addr[2] not in self.bench_symbols:
+        fun_name = addr[len(self.env_addr_prefix) : -len(self.env_addr_suffix)].decode(
+            "utf-8"
+        )
+        if fun_name not in self.env_addresses:
             print(
                 f"Got message from env with incorrect function name. "
-                f"Got '{parsed_addr[2]}'",
+                f"Got '{fun_name}'",
                 file=sys.stderr,
             )
             exit(1)
+        return fun_name
 
     def add_env_to_list(self, pass_list, addr):
         """
-        Parses address, validates it and adds received pass list to
+        Validates address and adds received pass list to
         dictionary of lists to be used during next compilation cycle
         """
-        parsed_addr = re.match("\0(.*):(.*)_(\d*)", addr.decode("utf-8"))
-        self.validate_addr(parsed_addr)
-        self.active_funcs_lists[parsed_addr[2]] = pass_list
+        self.active_funcs_lists[self.validate_addr(addr)] = pass_list
+
+    def bound_env_symbols(self):
+        """
+        Returns benchmark symbols whose environment sockets are currently bound
+
+        Abstract socket names are looked up in /proc/net/unix at once, so afk env
+        probing does not have to try sending to every symbol in turn
+        (falls back to all symbols if /proc/net/unix can not be read)
+        """
+        try:
+            unix_sockets = Path("/proc/net/unix").read_bytes().splitlines()
+        except OSError:
+            return self.bench_symbols
+        bound_names = set()
+        for line in unix_sockets:
+            pieces = line.split(None, 7)
+            if len(pieces) == 8 and pieces[7].startswith(b"@"):
+                bound_names.add(pieces[7])
+        return [
+            fun_name
+            for fun_name in self.bench_symbols
+            if b"@" + self.env_addresses[fun_name][1:] in bound_names
+        ]
+
+    def receive_env_lists(self):
+        """
+        Waits for pass list from env, then takes all lists already queued
+        on env socket with one recvmmsg call per batch
+        """
+        self.add_env_to_list(*self.env_socket.recvfrom(ENV_MSG_SIZE))
+        for pass_list, addr in self.env_batch.receive(self.env_socket):
+            self.add_env_to_list(pass_list, addr)
 
     def gather_active_envs(self):
         """
@@ -387,13 +991,13 @@ class MultienvBenchKernel:
 
             self.env_socket.settimeout(60)
             try:
-                self.add_env_to_list(*self.env_socket.recvfrom(4096))
+                self.receive_env_lists()
                 self.env_socket.settimeout(5)
                 logging.debug("KERNEL: got first env")
                 while True:
                     try:
                         logging.debug("KERNEL: env cycling wewo")
-                        self.add_env_to_list(*self.env_socket.recvfrom(4096))
+                        self.receive_env_lists()
                     except (TimeoutError, socket.timeout):
                         self.env_socket.settimeout(None)
                         break
@@ -401,16 +1005,11 @@ class MultienvBenchKernel:
             except (TimeoutError, socket.timeout):
                 logging.debug("KERNEL: Got in timeout")
                 afk_envs_exist = False
-                for fun_name in self.bench_symbols:
+                for fun_name in self.bound_env_symbols():
                     try:
-                        self.env_socket.sendto(
-                            bytes(0),
-                            f"\0{self.args.bench_name}:{fun_name}_{self.args.instance}".encode(
-                                "utf-8"
-                            ),
-                        )
+                        self.env_socket.sendto(bytes(0), self.env_addresses[fun_name])
                         afk_envs_exist = True
-                        logging.debug(f"KERNEL: saved by afk env '{fun_name}'")
+                        logging.debug("KERNEL: saved by afk env '%s'", fun_name)
                         break
                     except:
                         continue
@@ -418,59 +1017,132 @@ class MultienvBenchKernel:
                     logging.debug("KERNEL: I have fallen and will not get up")
                     exit(0)
 
-    def compile_for_size(self):
+    def gcc_build_str(self, kernel_socket_name, socket_postfix, flags, output):
         """
-        Compiles benchmark with received lists and record embeddings
+        Returns shell command that builds benchmark into output with extra flags,
+        its plugin talking to kernel_socket_name from gcc_plugin<socket_postfix>.soc
         """
-        self.embeddings = {}
-        self.gcc_instance = Popen(
-            self.build_str, shell=True
-        )  # Compile without gprof do all the compilation stuff
+        return (
+            f"exec $AARCH_GCC -fplugin={self.args.plugin_path} -O2 -pipe -fplugin-arg-plugin-dyn_replace=learning "
+            f"-fplugin-arg-plugin-remote_socket={kernel_socket_name} -fplugin-arg-plugin-socket_postfix={socket_postfix} "
+            f"{flags}{self.args.build_string} -o {output}"
+        )
 
-        while not os.path.exists(self.gcc_name):
-            self.gcc_instance.poll()
-            if self.gcc_instance.returncode != None:
-                print(
-                    f"gcc failed on startup: return code {self.gcc_instance.returncode}\n",
-                    file=sys.stderr,
-                )
-                exit(1)
-            pass
+    def compile_benchmarks(self, instrumented):
+        """
+        Compiles benchmark with received lists and records embeddings
 
-        while self.gcc_instance.poll() == None:
-            try:
-                fun_name = self.gcc_socket.recv(4096, socket.MSG_DONTWAIT).decode(
-                    "utf-8"
+        If instrumented is set, benchmark with enabled -pg flag (for per-function
+        runtime profiling) is compiled at the same time by second gcc, whose
+        plugin talks to its own kernel socket; requests of both are served from one loop
+        """
+        for fun_name in self.active_funcs_lists:
+            self.profiles[fun_name].reset()
+        self.gcc_compilations = [
+            GccCompilation(self.build_str, self.gcc_socket, self.gcc_name, True)
+        ]  # Compile without gprof do all the compilation stuff
+        if instrumented:
+            self.gcc_compilations.append(
+                GccCompilation(
+                    self.gprof_build_str, self.gprof_socket, self.gprof_gcc_name, False
                 )
-                sock_fun_name = self.encode_fun_name(fun_name)
-                if sock_fun_name in self.active_funcs_lists:
-                    logging.debug(f"KERNEL: Sending list for {sock_fun_name}")
-                    self.gcc_socket.sendto(
-                        self.active_funcs_lists[sock_fun_name],
-                        self.gcc_name.encode(),
-                    )
-                    logging.debug(
-                        f"KERNEL: Sent list {self.active_funcs_lists[sock_fun_name]} to gcc"
-                    )
-                    embedding = self.gcc_socket.recv(1024 * self.EMBED_LEN_MULTIPLIER)
-                    logging.debug(f"KERNEL: Got embedding from gcc")
-                    emb_len = bytes(struct.pack("i", len(embedding)))
-                    self.embeddings[sock_fun_name] = emb_len + embedding
-                else:
-                    logging.debug(f"KERNEL: No list for {sock_fun_name}")
-                    list_msg = bytes(1)
-                    self.gcc_socket.sendto(list_msg, self.gcc_name.encode())
-                    embedding = self.gcc_socket.recv(1024 * self.EMBED_LEN_MULTIPLIER)
-            except BlockingIOError:
-                pass
+            )  # Compile with gprof to get per-function runtime info
 
-        if self.gcc_instance.wait() != 0:
+        for compilation in self.gcc_compilations:
+            self.wait_gcc_startup(compilation)
+
+        with selectors.DefaultSelector() as selector:
+            for compilation in self.gcc_compilations:
+                selector.register(compilation.socket, selectors.EVENT_READ, compilation)
+                selector.register(compilation.pidfd, selectors.EVENT_READ, compilation)
+
+            while selector.get_map():
+                ready = selector.select()
+                # Requests from gcc that has already exited are not served
+                exited = {key.data for key, _ in ready if key.fd == key.data.pidfd}
+                for key, _ in ready:
+                    if key.data not in exited:
+                        self.serve_plugin_request(key.data)
+                    elif key.fd == key.data.pidfd:
+                        self.finish_compilation(key.data, selector)
+
+    def serve_plugin_request(self, compilation):
+        """
+        Receives function name from gcc plugin, replies with its pass list
+        (or empty message if there is none) and receives function embedding
+        """
+        raw_name = compilation.socket.recv(4096)
+        sock_fun_name = self.plugin_fun_names.get(raw_name)
+        if sock_fun_name == None:
+            sock_fun_name = self.encode_fun_name(raw_name.decode("utf-8"))
+            self.plugin_fun_names[raw_name] = sock_fun_name
+        if sock_fun_name in self.active_funcs_lists:
+            logging.debug("KERNEL: Sending list for %s", sock_fun_name)
+            compilation.socket.sendto(
+                self.active_funcs_lists[sock_fun_name],
+                compilation.plugin_addr,
+            )
+            logging.debug(
+                "KERNEL: Sent list %s to gcc", self.active_funcs_lists[sock_fun_name]
+            )
+            if compilation.record_embeddings:
+                # Received into scratch buffer and copied at its actual length,
+                # as recv() would allocate (and mmap) full 200 KB for every embedding
+                length = compilation.socket.recv_into(self.embedding_buf)
+                embedding = self.embedding_view[:length].tobytes()
+                logging.debug("KERNEL: Got embedding from gcc")
+                self.profiles[sock_fun_name].embedding = embedding
+                return
+        else:
+            logging.debug("KERNEL: No list for %s", sock_fun_name)
+            compilation.socket.sendto(self.empty_list_msg, compilation.plugin_addr)
+        compilation.socket.recv_into(self.embedding_buf)
+
+    def finish_compilation(self, compilation, selector):
+        """
+        Stops serving exited gcc and checks its return code
+        """
+        selector.unregister(compilation.socket)
+        selector.unregister(compilation.pidfd)
+        compilation.stop()
+        if compilation.instance.returncode != 0:
             print(
-                f"gcc failed: return code {self.gcc_instance.returncode}\n",
+                f"gcc failed: return code {compilation.instance.returncode}\n",
                 file=sys.stderr,
             )
+            self.stop_compilations()
             exit(1)
 
+    def stop_compilations(self):
+        """
+        Kills gcc instances that are still running, so plugin of second build
+        is not left waiting for reply after the other one failed
+        """
+        for compilation in self.gcc_compilations:
+            compilation.stop()
+
+    def cache_profiles(self, lists_key):
+        """
+        Saves profiles of active functions for pass list set lists_key,
+        evicting least recently used set if cache is full
+        """
+        if self.args.profile_cache_size <= 0:
+            return
+        self.profile_cache[lists_key] = {
+            fun_name: self.profiles[fun_name].copy()
+            for fun_name in self.active_funcs_lists
+        }
+        if len(self.profile_cache) > self.args.profile_cache_size:
+            self.profile_cache.popitem(last=False)
+
+    def restore_cached_profiles(self, lists_key):
+        """
+        Loads profiles of active functions saved for pass list set lists_key
+        """
+        self.profile_cache.move_to_end(lists_key)
+        for fun_name, record in self.profile_cache[lists_key].items():
+            self.profiles[fun_name] = record.copy()
+
     def kernel_loop(self):
         """
         Main kernel loop, which also catches exceptions
@@ -481,23 +1153,26 @@ class MultienvBenchKernel:
             while True:
                 logging.debug("KERNEL: compilation cucle")
                 self.gather_active_envs()
-                logging.debug(f"KERNEL: collected lists {self.active_funcs_lists}")
-                self.compile_for_size()
-                logging.debug("KERNEL: compiled for size")
-                self.get_sizes()
-                logging.debug("KERNEL: got sizes")
-                # Compile for runtimes and profile only if we have functions that are known
-                # to have non-zero runtime
-                if (
-                    len(set(self.active_funcs_lists.keys()) & set(self.long_functions))
-                    > 0
-                ):
-                    self.compile_instrumented()
-                    logging.debug("KERNEL: gprof compiled")
-                    self.get_runtimes()
-                    logging.debug("KERNEL: got runtimes")
+                logging.debug("KERNEL: collected lists %s", self.active_funcs_lists)
+                # Same pass lists produce same binaries, so their profiles are reused
+                lists_key = frozenset(self.active_funcs_lists.items())
+                if lists_key in self.profile_cache:
+                    self.restore_cached_profiles(lists_key)
+                    logging.debug("KERNEL: reused cached profiles")
                 else:
-                    self.runtimes = {}
+                    # Compile for runtimes and profile only if we have functions that are known
+                    # to have non-zero runtime
+                    instrumented = not self.long_functions.isdisjoint(
+                        self.active_funcs_lists
+                    )
+                    self.compile_benchmarks(instrumented)
+                    logging.debug("KERNEL: compiled benchmarks")
+                    self.get_sizes()
+                    logging.debug("KERNEL: got sizes")
+                    if instrumented:
+                        self.get_runtimes()
+                        logging.debug("KERNEL: got runtimes")
+                    self.cache_profiles(lists_key)
                 self.sendout_profiles()
                 logging.debug("KERNEL: sent profiles")
         except (Exception, SystemExit, KeyboardInterrupt) as e:
@@ -508,6 +1183,10 @@ class MultienvBenchKernel:
 if __name__ == "__main__":
     with socket.socket(
         socket.AF_UNIX, socket.SOCK_DGRAM, 0
-    ) as env_socket, socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0) as gcc_socket:
-        kernel = MultienvBenchKernel(env_socket, gcc_socket)
+    ) as env_socket, socket.socket(
+        socket.AF_UNIX, socket.SOCK_DGRAM, 0
+    ) as gcc_socket, socket.socket(
+        socket.AF_UNIX, socket.SOCK_DGRAM, 0
+    ) as gprof_socket:
+        kernel = MultienvBenchKernel(env_socket, gcc_socket, gprof_socket)
         kernel.kernel_loop()